@@ -1,29 +1,47 @@
 import sqlite3
+import asyncio
 import discord
 import json
-import regex as re
+import re
+import io
 import os
 from validator import *
 import traceback
+import logging
+from typing import Callable
 from db import DB
-from copy import deepcopy
 
-GUILD_TEMPLATE = {
-    'whitelist_channel': None,
-    'whitelist_role': None,
-    'blockchain': None,
-    'data': {}
-}
-VALID_BLOCKCHAINS = ['eth', 'sol']
+# Command patterns, always matched with `fullmatch` so they need no anchors.
+_CHANNEL_RE = re.compile(r">channel <#\d+>")
+_ROLE_RE = re.compile(r">role <@&\d+>")
+_BLOCKCHAIN_RE = re.compile(r">blockchain \w{3}")
+
+log = logging.getLogger(__name__)
+
+# Seconds between flushes of pending database writes.
+COMMIT_INTERVAL = 5
 
 
 class InvalidCommand(Exception):
     """
     An exception to be thrown when an invalid command is encountered
     """
+    __slots__ = ()
+
 
-    def __init__(self):
-        pass
+class GuildConfig:
+    """
+    The whitelist config of a single guild, mirroring a row of the `discord_server` table
+    """
+    __slots__ = ('whitelist_channel', 'whitelist_role', 'blockchain', 'validator')
+
+    def __init__(self, whitelist_channel: int = None, whitelist_role: int = None, blockchain: str = None,
+                 validator: Callable[[str], bool] = None):
+        self.whitelist_channel = whitelist_channel
+        self.whitelist_role = whitelist_role
+        self.blockchain = blockchain
+        # The address validator for `blockchain`, resolved when the blockchain is set.
+        self.validator = validator
 
 
 class WhitelistClient(discord.Client):
@@ -34,10 +52,11 @@ class WhitelistClient(discord.Client):
     def __init__(self, db: DB, *, loop=None, **options):
         """
         Args:
-            data (dict): A data dictionary stored in memory.
+            db (DB): The database used to persist guild configs and wallets.
         """
         super().__init__(loop=loop, **options)
         self.db = db
+        # GuildConfig for each guild, keyed by the integer guild id.
         self.data = {}
         self.admin_commands = {
             'channel': self.set_whitelist_channel,
@@ -56,28 +75,103 @@ class WhitelistClient(discord.Client):
             'eth': validate_eth,
             'sol': validate_sol
         }
-        self.regex = {
-            'channel': re.compile(">channel <#\d+>$"),
-            'role': re.compile(">role <@&\d+>$"),
-            'blockchain': re.compile(">blockchain \w{3}")
-        }
+        # The help screens are static, so they are built once and reused.
+        self._help_embed = discord.Embed(
+            title="Whitelist Manager Help",
+            description="Whitelist Manager is a bot designed to assist in gathering wallet addresses for NFT drops.")
+        self._help_embed.add_field(
+            name="COMMANDS",
+            value="`>check`: will tell you whether or not your wallet has been recorded in the whitelist\n`>help`: This screen\n`>help.admin`: Provides a help screen to assist in configuring the bot (admin only).\n\nHow to use: Send your wallet address to the whitelist chat to record it!\nThe message should contain just the wallet address (no `>`).")
+        self._help_admin_embed = discord.Embed(
+            title="Whitelist Manager Help (Admin)",
+            description="Whitelist Manager is a bot designed to assist you in gathering wallet addresses for NFT drops.\nAfter configuring the discord bot, users who are 'whitelisted' will be able to record their crypto addresses which you can then download as a CSV.\nNote, the `config` must be filled out before the bot will work.")
+        self._help_admin_embed.add_field(
+            name="COMMANDS",
+            value="`>channel #channelName`: Sets the channel to listen for wallet addresses on.\n`>role @roleName`: Sets the role a user must possess to be able to add their address to the whitelist.\n`>blockchain eth/sol`: Select which blockchain this NFT drop will occur on, this allows for validation of the addresses that are added.\n`>config`: View the current server config.\n`>data`: Get discordID:walletAddress pairs in a CSV format.\n`>clear`: Clear the config and data for this server.\n`>help.admin`: This screen.\n`>help`: How to use help screen.")
+        self._public_cmd_help = ", ".join(f"`{cmd}`" for cmd in self.public_commands)
+        self._commit_pending = False
+        self._commit_task = None
+        self._log_file = open('log.txt', 'ab')
 
     def _log(self, head: str, text: str) -> None:
-        with open('log.txt', 'a+') as log:
-            log.write(f"Head: {head}\n   Text: {str(text)}\n\n")
+        self._log_file.write(f"Head: {head}\n   Text: {text}\n\n".encode())
+        self._log_file.flush()
+
+    def _get_guild(self, guild_id: int) -> GuildConfig:
+        """ Returns the cached config for a guild, loading it from the database on first use.
+
+        Args:
+            guild_id (int): The id of the guild.
+
+        Returns:
+            GuildConfig: The guild's config, or None if the guild is not in the database.
+        """
+        config = self.data.get(guild_id)
+        if config is None:
+            row = self.db.execute(
+                "SELECT * FROM discord_server WHERE id = ?", (guild_id,)).fetchone()
+            if row is None:
+                return None
+            config = GuildConfig(row['whitelist_channel'], row['whitelist_role'], row['blockchain'],
+                                 self.validators.get(row['blockchain']))
+            self.data[guild_id] = config
+        return config
+
+    def _add_guild(self, guild_id: int) -> bool:
+        """ Adds an empty config for a guild to the database if it does not already have one.
+
+        Args:
+            guild_id (int): The id of the guild.
+
+        Returns:
+            bool: True if the guild was added, false if it already existed.
+        """
+        added = self.db.execute("INSERT OR IGNORE INTO discord_server VALUES (?,?,?,?)",
+                                (guild_id, None, None, None)).rowcount > 0
+        if added:
+            self._schedule_commit()
+            self.data[guild_id] = GuildConfig()
+        return added
+
+    def _schedule_commit(self) -> None:
+        """ Marks the database as having uncommitted writes, they are flushed by `_commit_loop`. """
+        self._commit_pending = True
+
+    def _commit_now(self) -> None:
+        """ Commits immediately, including any writes pending from `_schedule_commit`. """
+        self.db.commit()
+        self._commit_pending = False
+
+    def _flush_commit(self) -> None:
+        """ Commits writes pending from `_schedule_commit`, if there are any. """
+        if self._commit_pending:
+            self._commit_now()
+
+    async def _commit_loop(self) -> None:
+        """ Periodically commits pending writes so the event loop is not blocked on every change. """
+        while not self.is_closed():
+            await asyncio.sleep(COMMIT_INTERVAL)
+            try:
+                self._flush_commit()
+            except Exception:
+                # Keep looping, the writes stay pending and are retried on the next flush.
+                tb = traceback.format_exc()
+                self._log(tb.replace('\n', '---'), "Failed to commit pending writes.")
+
+    async def close(self) -> None:
+        await super().close()
+        self._flush_commit()
+        self._log_file.close()
 
     async def on_ready(self) -> None:
-        print('Logged in as')
-        print(self.user.name)
-        print(self.user.id)
-        print("Initialising...")
+        log.info("Logged in as %s (%s)", self.user.name, self.user.id)
+        log.info("Initialising...")
+        if self._commit_task is None:
+            self._commit_task = asyncio.ensure_future(self._commit_loop())
         async for guild in self.fetch_guilds():
-            if self.db.execute('SELECT * FROM discord_server WHERE id=?', (guild.id,)).fetchone() is None:
-                print(f"Adding guild '{str(guild)}' to database.")
-                self.db.execute(
-                    "INSERT INTO discord_server VALUES (?,?,?,?)", (guild.id, None, None, None))
-                self.db.commit()
-        print("-------------")
+            if self._add_guild(guild.id):
+                log.info("Adding guild '%s' to database.", guild)
+        log.info("Ready.")
 
     async def set_whitelist_channel(self, message: discord.Message) -> None:
         """ Handles setting the channel that will be used for whitelisting
@@ -89,12 +183,15 @@ class WhitelistClient(discord.Client):
             InvalidCommand: The message structure was not as expected.
         """
         channels = message.channel_mentions
-        if len(channels) != 1 or not self.regex['channel'].fullmatch(message.content):
+        if len(channels) != 1 or not _CHANNEL_RE.fullmatch(message.content):
             raise InvalidCommand()
 
         self.db.execute("UPDATE discord_server SET whitelist_channel = ? WHERE id = ?",
                         (channels[0].id, message.guild.id))
-        self.db.commit()
+        self._commit_now()
+        config = self._get_guild(message.guild.id)
+        if config is not None:
+            config.whitelist_channel = channels[0].id
 
         await message.reply(f"Successfully set whitelist channel to <#{channels[0].id}>",
                             mention_author=True)
@@ -109,12 +206,15 @@ class WhitelistClient(discord.Client):
             InvalidCommand: The message structure was not as expected.
         """
         roles = message.role_mentions
-        if len(roles) != 1 or not self.regex['role'].fullmatch(message.content):
+        if len(roles) != 1 or not _ROLE_RE.fullmatch(message.content):
             raise InvalidCommand()
 
         self.db.execute("UPDATE discord_server SET whitelist_role = ? WHERE id = ?",
                         (roles[0].id, message.guild.id))
-        self.db.commit()
+        self._commit_now()
+        config = self._get_guild(message.guild.id)
+        if config is not None:
+            config.whitelist_role = roles[0].id
 
         await message.reply(f"Successfully set whitelist role to <@&{roles[0].id}>",
                             mention_author=True)
@@ -129,11 +229,15 @@ class WhitelistClient(discord.Client):
             InvalidCommand: The message structure was not as expected.
         """
         code = message.content[-3:]
-        if code in VALID_BLOCKCHAINS:
+        if _BLOCKCHAIN_RE.fullmatch(message.content) and code in self.validators:
 
             self.db.execute(
                 "UPDATE discord_server SET blockchain = ? WHERE id = ?", (code, message.guild.id))
-            self.db.commit()
+            self._commit_now()
+            config = self._get_guild(message.guild.id)
+            if config is not None:
+                config.blockchain = code
+                config.validator = self.validators[code]
 
             await message.reply(f"Successfully set blockchain to `{code}`", mention_author=True)
         else:
@@ -145,14 +249,13 @@ class WhitelistClient(discord.Client):
         Args:
             message (discord.Message): The discord message that sent the request.
         """
-        row = self.db.execute(
-            "SELECT * FROM discord_server WHERE id = ?", (message.guild.id,)).fetchone()
-        if row is None:
+        config = self._get_guild(message.guild.id)
+        if config is None:
             return
         replyStr = f"""
-        Whitelist Channel: {"None" if row["whitelist_channel"] is None else f"<#{row['whitelist_channel']}>"}
-        Whitelist Role: {"None" if row["whitelist_role"] is None else f"<@&{row['whitelist_role']}>"}
-        Blockchain: {row['blockchain']}
+        Whitelist Channel: {"None" if config.whitelist_channel is None else f"<#{config.whitelist_channel}>"}
+        Whitelist Role: {"None" if config.whitelist_role is None else f"<@&{config.whitelist_role}>"}
+        Blockchain: {config.blockchain}
         """
         reply = discord.Embed(
             title=f'Config for {message.guild}', description=replyStr)
@@ -165,15 +268,12 @@ class WhitelistClient(discord.Client):
         Args:
             message (discord.Message): The discord message that sent the request.
         """
-        file_name = f'{message.guild.id}.csv'
-        with open(file_name, 'w+') as out_file:
-            out_file.write('userId, walletAddress\n')
-            out_file.writelines(
-                map(lambda t: f"{t['id']},{t['wallet']}\n", self.db.execute("SELECT id, wallet FROM user WHERE discord_server = ?", (message.guild.id,)).fetchall()))
-            out_file.flush()
+        rows = self.db.execute(
+            "SELECT id, wallet FROM user WHERE discord_server = ?", (message.guild.id,))
+        csv = 'userId, walletAddress\n' + ''.join(f"{user_id},{wallet}\n" for user_id, wallet in rows)
+        out_file = io.BytesIO(csv.encode())
         await message.reply('Data for server is attached.',
-                            file=discord.File(file_name))
-        os.remove(file_name)
+                            file=discord.File(out_file, filename=f'{message.guild.id}.csv'))
 
     async def clear_data(self, message: discord.Message) -> None:
         """ Clears the data and config currently stored by the bot regarding the current server
@@ -185,7 +285,8 @@ class WhitelistClient(discord.Client):
             "DELETE FROM discord_server WHERE id = ?", (message.guild.id,))
         self.db.execute("INSERT INTO discord_server VALUES (?,?,?,?)",
                         (message.guild.id, None, None, None))
-        self.db.commit()
+        self._commit_now()
+        self.data[message.guild.id] = GuildConfig()
         await message.reply("Server's data has been cleared.")
 
     async def help_admin(self, message: discord.Message) -> None:
@@ -194,12 +295,7 @@ class WhitelistClient(discord.Client):
         Args:
             message (discord.Message): The discord message that sent the request.
         """
-        msg = discord.Embed(title="Whitelist Manager Help (Admin)")
-        desc = "Whitelist Manager is a bot designed to assist you in gathering wallet addresses for NFT drops.\nAfter configuring the discord bot, users who are 'whitelisted' will be able to record their crypto addresses which you can then download as a CSV.\nNote, the `config` must be filled out before the bot will work."
-        body = "`>channel #channelName`: Sets the channel to listen for wallet addresses on.\n`>role @roleName`: Sets the role a user must possess to be able to add their address to the whitelist.\n`>blockchain eth/sol`: Select which blockchain this NFT drop will occur on, this allows for validation of the addresses that are added.\n`>config`: View the current server config.\n`>data`: Get discordID:walletAddress pairs in a CSV format.\n`>clear`: Clear the config and data for this server.\n`>help.admin`: This screen.\n`>help`: How to use help screen."
-        msg.description = desc
-        msg.add_field(name="COMMANDS", value=body)
-        await message.reply(embed=msg)
+        await message.reply(embed=self._help_admin_embed)
 
     async def help(self, message: discord.Message) -> None:
         """ Returns a window that provides some help messages regarding how to use the bot.
@@ -207,21 +303,31 @@ class WhitelistClient(discord.Client):
         Args:
             message (discord.Message): The discord message that sent the request.
         """
-        msg = discord.Embed(title="Whitelist Manager Help")
-        desc = "Whitelist Manager is a bot designed to assist in gathering wallet addresses for NFT drops."
-        body = "`>check`: will tell you whether or not your wallet has been recorded in the whitelist\n`>help`: This screen\n`>help.admin`: Provides a help screen to assist in configuring the bot (admin only).\n\nHow to use: Send your wallet address to the whitelist chat to record it!\nThe message should contain just the wallet address (no `>`)."
-        msg.description = desc
-        msg.add_field(name="COMMANDS", value=body)
-        await message.reply(embed=msg)
+        await message.reply(embed=self._help_embed)
 
     async def check(self, message: discord.Message) -> None:
-        row = db.execute("SELECT * FROM user WHERE id = ? AND discord_server = ?",
-                         (message.author.id, message.guild.id)).fetchone()
+        row = self.db.execute("SELECT * FROM user WHERE id = ? AND discord_server = ?",
+                              (message.author.id, message.guild.id)).fetchone()
         if row is not None:
             await message.reply(f"You are whitelisted! The last 3 digits of your wallet are: `{row['wallet'][-3:]}`")
         else:
             await message.reply(f"Your wallet is not yet on the whitelist. Use `>help` for more info!.")
 
+    def _can_whitelist(self, message: discord.Message, config: GuildConfig) -> bool:
+        """ Determines whether a message was sent in the whitelist channel by a user with the whitelist role.
+
+        Args:
+            message (discord.Message): The discord message to check.
+            config (GuildConfig): The config of the guild the message was sent in.
+
+        Returns:
+            bool: True if the author may add their wallet from this channel, false otherwise.
+        """
+        # Most messages are outside the whitelist channel, so rule those out before touching roles.
+        if config is None or message.channel.id != config.whitelist_channel:
+            return False
+        return config.whitelist_role in {role.id for role in message.author.roles}
+
     async def on_message(self, message: discord.Message) -> None:
         """ Responds to the 'on_message' event. Runs the appropriate commands given the user has valid privellages.
 
@@ -234,54 +340,50 @@ class WhitelistClient(discord.Client):
             if message.author.bot or not isinstance(message.author, discord.member.Member):
                 return
 
+            content = message.content
+            guild_id = message.guild.id
+
             # Handle commands
-            if message.author.guild_permissions.administrator and message.content.startswith(">"):
-                command = message.content.split()[0][1:]
-                if command in self.admin_commands.keys():
-                    try:
-                        await self.admin_commands[command](message)
-                        return
-                    except InvalidCommand:
-                        await message.reply("Invalid command argument.", mention_author=True)
-                    return
-                if command in self.public_commands.keys():
-                    try:
-                        await self.public_commands[command](message)
-                        return
-                    except InvalidCommand:
-                        await message.reply("Invalid command argument.", mention_author=True)
-                    return
+            if content.startswith('>'):
+                command = content.split(None, 1)[0][1:]
+                log.debug("Command (from %s): %s", message.author.id, content)
+                is_admin = message.author.guild_permissions.administrator
+                handler = self.admin_commands.get(command) if is_admin else None
+                if handler is None:
+                    handler = self.public_commands.get(command)
+                    # Non-admins may only use commands from the whitelist channel.
+                    if handler is None or not is_admin:
+                        if not self._can_whitelist(message, self._get_guild(guild_id)):
+                            return
+                        if handler is None:
+                            await message.reply(f'Valid commands are: {self._public_cmd_help}, use `>help` for more info.')
+                            return
+                try:
+                    await handler(message)
+                except InvalidCommand:
+                    await message.reply("Invalid command argument.", mention_author=True)
+                return
 
             # Handle whitelist additions
-            server = self.db.execute(
-                "SELECT * FROM discord_server WHERE id =?", (message.guild.id,)).fetchone()
-            if (message.channel.id == server["whitelist_channel"] and server["whitelist_role"] in map(lambda x: x.id, message.author.roles)):
-                if message.content.startswith('>'):
-                    command = message.content.split()[0][1:]
-                    if command in self.public_commands.keys():
-                        try:
-                            await self.public_commands[command](message)
-                            return
-                        except InvalidCommand:
-                            await message.reply("Invalid command argument.", mention_author=True)
-                    else:
-                        commands = str(list(self.public_commands.keys()))[
-                            1:-1].replace("'", "`")
-                        await message.reply(f'Valid commands are: {commands}, use `>help` for more info.')
-                    return
-                
-                if server["blockchain"] is None: return
-
-                if self.validators[server["blockchain"]](message.content):
-                    db.execute("DELETE FROM user WHERE id = ? and discord_server = ?", (message.author.id, message.guild.id))
-                    db.execute("INSERT INTO user (id, discord_server, wallet) VALUES (?, ?, ?)", (message.author.id, message.guild.id, message.content))
-                    db.commit()
-                    await message.reply(
-                        f"<@{message.author.id}> your wallet ending in `{message.content[-3:]}` has been validated and recorded.", mention_author=True)
-                else:
-                    await message.reply(f"The address ending in `{message.content[-3:]}` is invalid.")
-                
-                await message.delete()
+            config = self._get_guild(guild_id)
+            if not self._can_whitelist(message, config):
+                return
+
+            validator = config.validator
+            if validator is None:
+                return
+
+            if validator(content):
+                author_id = message.author.id
+                self.db.execute("INSERT OR REPLACE INTO user (id, discord_server, wallet) VALUES (?, ?, ?)", (author_id, guild_id, content))
+                # The wallet must be durable before the user is told it was recorded.
+                self._commit_now()
+                await message.reply(
+                    f"<@{author_id}> your wallet ending in `{content[-3:]}` has been validated and recorded.", mention_author=True)
+            else:
+                await message.reply(f"The address ending in `{content[-3:]}` is invalid.")
+
+            await message.delete()
         except Exception:
             tb = traceback.format_exc()
             exception_string = tb.replace('\n', '---')
@@ -295,14 +397,13 @@ class WhitelistClient(discord.Client):
             guild (discord.Guild): The guild that the server has joined
 
         """
-        if db.execute("SELECT * FROM discord_server WHERE id=?", (guild.id,)).fetchone() is None:
-            db.execute("INSERT INTO discord_server VALUES (?,?,?,?)", (guild.id, None, None, None))
-            db.commit()
+        self._add_guild(guild.id)
 
         self._log("New Guild", f"{guild.id}, {guild.name}")
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
     access_token = os.environ["ACCESS_TOKEN"]
     db = DB('data.db')
     client = WhitelistClient(db)
@@ -5,14 +5,18 @@ This is to not lose old data and maintain consistency in the DB
 """
 
 from ..db import DB
-import json
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 NEW_DB_NAME = "new_data.db"
 OLD_JSON_FILE = "data.json"
 
 db = DB(NEW_DB_NAME)
-with open(OLD_JSON_FILE, 'r') as in_file:
-    old_data = json.load(in_file)
+with open(OLD_JSON_FILE, 'rb') as in_file:
+    old_data = json_loads(in_file.read())
 for server in old_data:
     channel = old_data[server]["whitelist_channel"]
     role = old_data[server]["whitelist_role"]
@@ -23,7 +23,7 @@ class WhitelistClient(discord.Client):
         print(self.user.id)
         print("Removing dead servers...")
         bad_servers = self.db.execute('SELECT id FROM discord_server as ds WHERE NOT EXISTS (SELECT * FROM user WHERE discord_server = ds.id)').fetchall()
-        bad_servers = [server['id'] for server in bad_servers]
+        bad_servers = {server['id'] for server in bad_servers}
 
         async for guild in self.fetch_guilds():
             if guild.id in bad_servers:
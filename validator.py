@@ -1,9 +1,9 @@
-import regex as re
+import re
 from Crypto.Hash import keccak
 
 non_checksummed_patterns = (re.compile(
-    "^(0x)?[0-9a-f]{40}$"), re.compile("^(0x)?[0-9A-F]{40}$"))
-sol_pattern = re.compile('[0-9a-zA-Z]{32,44}$')
+    "(0x)?[0-9a-f]{40}"), re.compile("(0x)?[0-9A-F]{40}"))
+sol_pattern = re.compile('[0-9a-zA-Z]{32,44}')
 
 
 def validate_eth(addr: str) -> bool:
@@ -16,7 +16,7 @@ def validate_eth(addr: str) -> bool:
         bool: True if the address is valid, false otherwise.
     """
     address = addr
-    if any(bool(pat.match(address))
+    if any(bool(pat.fullmatch(address))
             for pat in non_checksummed_patterns):
         return True
     if not address.startswith('0x'):